@@ -1,13 +1,16 @@
-import json
 import logging
+import math
+import os
 import pathlib
 import random
 import sys
-from functools import wraps
+from functools import lru_cache, wraps
 from itertools import cycle
-from typing import Callable, List, Optional, Union
+from typing import Callable, List, Union
 
 import click
+import numpy as np
+import orjson
 import trio
 from trio_websocket import ConnectionClosed, HandshakeError, open_websocket_url
 
@@ -32,120 +35,168 @@ def bus_faker(server, routes_number, buses_per_route, websockets_number, emulato
     }
     verbose = 2 if verbose > 2 else verbose
     logger.setLevel(level=log_level[verbose])
-    max_routes = sum(1 for _ in pathlib.Path('routes').glob('*.json'))
+    route_files = find_route_files()
+    max_routes = len(route_files)
     if not routes_number:
         logger.warning(f'Number of routes is not set - using all possbile routes - {max_routes} routes.')
         routes_number = max_routes
     if routes_number > max_routes:
         logger.error(f'We have information only about {max_routes} different routes. You have specified {routes_number} routes.')
         sys.exit()
-    trio.run(main, server, routes_number, buses_per_route, websockets_number, emulator_id, refresh_timeout)
+    trio.run(main, server, route_files[:routes_number], buses_per_route, websockets_number, emulator_id, refresh_timeout)
 
 
 async def main(server_url: str,
-               routes_number: int,
+               route_files: List[pathlib.Path],
                buses_per_route: int,
                websockets_number: int,
                emulator_id: str,
                refresh_timeout: Union[int, float],
                ) -> None:
     """Entrypoint to run all async machinery."""
-    send_channels = []
+    buses_groups = [[] for _ in range(websockets_number)]
+    group_choice = cycle(buses_groups)
+    for route in await load_routes(route_files):
+        route_points = serialize_route_points(route['name'], route['coordinates'])
+        for bus_num in range(buses_per_route):
+            start_offset = random.randint(0, len(route_points) - 1)
+            bus_id = generate_bus_id(route_id=route['name'], bus_index=bus_num, prefix=emulator_id)
+            next(group_choice).append(FakeBus(bus_id, route_points, start_offset))
+    # There may be fewer buses than websockets. A websocket without buses would only send empty updates.
+    buses_groups = [buses for buses in buses_groups if buses]
     async with trio.open_nursery() as nursery:
-        logger.info(f'Open {websockets_number} channels.')
-        for _ in range(websockets_number):
-            snd_channel, rcv_channel = trio.open_memory_channel(0)
-            send_channels.append(snd_channel)
-            nursery.start_soon(send_bus_updates, server_url, rcv_channel)  # consumer
-        logger.info(f'Start emulating {routes_number} buses.')
-        channel_choice = cycle(send_channels)
-        for route in load_routes(max_routes=routes_number):
-            for bus_num in range(buses_per_route):
-                start_offset = random.randint(0, len(route['coordinates']) - 1)
-                bus_id = generate_bus_id(route_id=route['name'], bus_index=bus_num, prefix=emulator_id)
-                bus_send_channel = next(channel_choice)
-                nursery.start_soon(run_bus,
-                                   bus_send_channel,
-                                   bus_id,
-                                   route['name'],
-                                   route['coordinates'],
-                                   start_offset,
-                                   refresh_timeout,
-                                   )
+        logger.info(f'Open {len(buses_groups)} websockets.')
+        for buses in buses_groups:
+            nursery.start_soon(send_bus_updates, server_url, buses, refresh_timeout)
+        logger.info(f'Start emulating {len(route_files) * buses_per_route} buses.')
         logger.warning('Booted up. Sending fake data')
 
 def generate_bus_id(route_id: str, bus_index: int, prefix=''):
     return f'{prefix}{route_id}-{bus_index}'
 
-def load_routes(directory_path: str = 'routes', max_routes: Optional[int] = None):
-    dir_path = pathlib.Path(directory_path)
-    for file_num, route_file in enumerate(dir_path.glob('*.json'), start=1):
-        if max_routes and file_num > max_routes:
-            break
-        yield json.loads(route_file.read_text())
+@lru_cache(maxsize=None)
+def _parse_route(path: str) -> dict:
+    """
+    Read and parse a route file. Routes never change so it's done once per file.
+
+    Coordinates are packed into (N, 2) array of floats - it takes a fraction
+    of memory comparing to a list of lists with python floats.
+    """
+    route = orjson.loads(pathlib.Path(path).read_bytes())
+    route['coordinates'] = np.array(route['coordinates'], dtype=np.float64)
+    return route
+
+
+def find_route_files(directory_path: str = 'routes') -> List[pathlib.Path]:
+    """Return sorted list of route files. Directory is flat, so plain listing is enough - no need for glob."""
+    return sorted(path for path in pathlib.Path(directory_path).iterdir() if path.suffix == '.json')
+
+
+async def load_routes(route_files: List[pathlib.Path]) -> List[dict]:
+    """
+    Read and parse route files in worker threads.
+
+    Files are split into a chunk per CPU, so reading of different files overlaps
+    without paying for a thread switch per file.
+    """
+    chunk_size = math.ceil(len(route_files) / (os.cpu_count() or 1)) or 1
+    chunks = [route_files[start:start + chunk_size] for start in range(0, len(route_files), chunk_size)]
+    parsed_chunks = [[] for _ in chunks]
+
+    def parse_chunk(index: int) -> None:
+        parsed_chunks[index] = [_parse_route(str(route_file)) for route_file in chunks[index]]
+
+    async with trio.open_nursery() as nursery:
+        for index in range(len(chunks)):
+            nursery.start_soon(trio.to_thread.run_sync, parse_chunk, index)
+    return [route for parsed_chunk in parsed_chunks for route in parsed_chunk]
+
+
+def serialize_route_points(route_name: str, route: np.ndarray) -> List[bytes]:
+    """
+    Serialize the part of bus messages which is the same for every bus on a route.
+
+    Result for every point of a route looks like '"lat":55.03332,"lng":35.4564,"route":"14k"}'.
+    """
+    route_suffix = b',"route":%s}' % orjson.dumps(route_name)
+    return [b'"lat":%r,"lng":%r%s' % (lat, lng, route_suffix) for lat, lng in route.tolist()]
+
+
+class FakeBus:
+    """
+    Bus running through its route.
 
+    :param bus_id: Unique bus id
+    :param route_points: Serialized route points, see `serialize_route_points`.
+    :param start_offset: Start bus from point with this index on a route
+    """
+
+    __slots__ = ('message_prefix', 'route_points', 'offset')
+
+    def __init__(self, bus_id: str, route_points: List[bytes], start_offset: int):
+        # Only busId differs between buses on a route, so route points are shared and the bus keeps just the prefix.
+        self.message_prefix = b'{"busId":%s,' % orjson.dumps(bus_id)
+        self.route_points = route_points
+        self.offset = start_offset
+
+    def move(self) -> bytes:
+        """Move the bus to the next point and return serialized coordinates update."""
+        message = self.message_prefix + self.route_points[self.offset]
+        # After reaching the end of route the bus starts from the beginning.
+        self.offset = (self.offset + 1) % len(self.route_points)
+        return message
+
+
+def relaunch_on_disconnect(delay: Union[int, float], max_delay: Union[int, float] = 30) -> Callable:
+    """
+    Relaunch a coroutine when its websocket is closed or can't be opened.
+
+    Failed connection attempts in a row are retried with exponential backoff (up to `max_delay`) with jitter,
+    so websockets don't hammer a server in lock-step while it's down.
+    """
+    # Past this number of failures the backoff is capped by max_delay anyway, so the counter stops there.
+    max_failed_attempts = max(0, math.ceil(math.log2(max_delay / delay)))
 
-def relaunch_on_disconnect(delay: Union[int, float]) -> Callable:
     def deco(a_func):
         @wraps(a_func)
         async def wrapped(*args, **kwargs):
+            failed_attempts = 0
             while True:
                 try:
                     await a_func(*args, **kwargs)
                 except ConnectionClosed as cc:
                     reason = '<no reason>' if cc.reason.reason is None else f'"{cc.reason.reason}"'
                     logger.error(f'Websocket closed: {cc.reason.code}/{cc.reason.name} {reason}')
-                    await trio.sleep(delay)
+                    failed_attempts = 0  # The connection was established, so the server was up.
                 except HandshakeError as he:
                     logger.error(f'Websocket connection attempt failed {he}')
-                    await trio.sleep(delay)
+                backoff = min(max_delay, delay * 2 ** failed_attempts) * random.uniform(0.5, 1.5)
+                failed_attempts = min(failed_attempts + 1, max_failed_attempts)
+                await trio.sleep(backoff)
         return wrapped
     return deco
 
 
 @relaunch_on_disconnect(delay=1)
 async def send_bus_updates(server_address: str,
-                           receive_channel: trio.MemoryReceiveChannel) -> None:
-    """Consume updates from trio channel and send them to a server via websockets."""
-    async with open_websocket_url(server_address) as ws:
-        logger.debug(f'Established connection with {server_address}')
-        async for message in receive_channel:
-            await ws.send_message(json.dumps(message, ensure_ascii=False))
-
-
-async def run_bus(bus_channel: trio.MemorySendChannel,
-                  bus_id: str,
-                  route_name: str,
-                  route: List[List[float]],
-                  start_offset: int,
-                  refresh_timeout: Union[float, int],
-                  ) -> None:
+                           buses: List[FakeBus],
+                           refresh_timeout: Union[float, int],
+                           ) -> None:
     """
-    Run bus through its route.
+    Run a group of buses through their routes and send their updates to a server via websockets.
 
-    :param bus_channel: Trio channel to send coordinate updates
-    :param bus_id: Unique bus id
-    :param route_name: Name of bus route (on one route can be many buses)
-    :param route: A list of coordinates on a route.
-    :param start_offset: Start bus from point with this index on a route
+    All buses of the group move at once, so there is one sleep and one websocket frame per tick.
+
+    :param server_address: Websocket server address
+    :param buses: Buses to move
     :param refresh_timeout: Pause between coordinate updates
     """
-    async with bus_channel:
+    async with open_websocket_url(server_address) as ws:
+        logger.debug(f'Established connection with {server_address}')
         while True:
-            for lat, lng in route[start_offset:]:
-                message = {
-                    'busId': bus_id,
-                    'lat': lat,
-                    'lng': lng,
-                    'route': route_name,
-                }
-                try:
-                    await bus_channel.send(message)
-                except trio.BrokenResourceError:
-                    logger.error('run_bus: Bus coordinates consumer has closed. No point of sending them.')
-                    return
-                await trio.sleep(refresh_timeout)
-            start_offset = 0  # After reaching the end of route the bus starts from the beginning.
+            # Updates of the whole group go to the server as one JSON array.
+            await ws.send_message(b'[%s]' % b','.join([bus.move() for bus in buses]))
+            await trio.sleep(refresh_timeout)
 
 
 if __name__ == '__main__':
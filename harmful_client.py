@@ -1,109 +1,46 @@
-import json
 import logging
+import orjson
 import trio
 from trio_websocket import open_websocket_url
 
+_VALID_BOUNDS = {
+    'east_lng': 37.65563964843751,
+    'north_lat': 55.77367652953477,
+    'south_lat': 55.72628839374007,
+    'west_lng': 37.54440307617188,
+}
+
+
+def _bounds_without(field: str) -> dict:
+    return {name: value for name, value in _VALID_BOUNDS.items() if name != field}
+
+
 _BAD_MESSAGES = {
-    'wrong msgType': {
-                'msgType': 'notSoNewBound',
-                'data': {
-                    'east_lng': 37.65563964843751,
-                    'north_lat': 55.77367652953477,
-                    'south_lat': 55.72628839374007,
-                    'west_lng': 37.54440307617188,
-                }
-    },
-    'wrong east_lng': {
-                'msgType': 'newBounds',
-                'data': {
-                    'east_lng': '37.65563964843751-string',
-                    'north_lat': 55.77367652953477,
-                    'south_lat': 55.72628839374007,
-                    'west_lng': 37.54440307617188,
-                }
-    },
-    'wrong north_lat': {
-                'msgType': 'newBounds',
-                'data': {
-                    'east_lng': 37.65563964843751,
-                    'north_lat': 'not-digit-55.77367652953477',
-                    'south_lat': 55.72628839374007,
-                    'west_lng': 37.54440307617188,
-                },
-    },
-    'wrong south_lat': {
-                'msgType': 'newBounds',
-                'data': {
-                    'east_lng': 37.65563964843751,
-                    'north_lat': 55.77367652953477,
-                    'south_lat': 'not-digit-55.72628839374007',
-                    'west_lng': 37.54440307617188,
-                },
-    },
-    'wrong west_lng': {
-                'msgType': 'newBounds',
-                'data': {
-                    'east_lng': 37.65563964843751,
-                    'north_lat': 55.77367652953477,
-                    'south_lat': 55.72628839374007,
-                    'west_lng': 'not-digit-37.54440307617188',
-                },
-    },
+    'wrong msgType': {'msgType': 'notSoNewBound', 'data': _VALID_BOUNDS},
+    'wrong east_lng': {'msgType': 'newBounds', 'data': {**_VALID_BOUNDS, 'east_lng': '37.65563964843751-string'}},
+    'wrong north_lat': {'msgType': 'newBounds', 'data': {**_VALID_BOUNDS, 'north_lat': 'not-digit-55.77367652953477'}},
+    'wrong south_lat': {'msgType': 'newBounds', 'data': {**_VALID_BOUNDS, 'south_lat': 'not-digit-55.72628839374007'}},
+    'wrong west_lng': {'msgType': 'newBounds', 'data': {**_VALID_BOUNDS, 'west_lng': 'not-digit-37.54440307617188'}},
     'empty message': {},
     'wrong structure': {'query': 'passwords'},
-    'without msgType': {
-                'data': {
-                    'east_lng': 37.65563964843751,
-                    'north_lat': 55.77367652953477,
-                    'south_lat': 55.72628839374007,
-                    'west_lng': 37.54440307617188,
-                },
-    },
-    'without data': {
-                'msgType': 'newBounds',
-    },
-    'without data->east_lng': {
-                'msgType': 'newBounds',
-                'data': {
-                    'north_lat': 55.77367652953477,
-                    'south_lat': 55.72628839374007,
-                    'west_lng': 37.54440307617188,
-                },
-    },
-    'without data->north_lat': {
-                'msgType': 'newBounds',
-                'data': {
-                    'east_lng': 37.65563964843751,
-                    'south_lat': 55.72628839374007,
-                    'west_lng': 37.54440307617188,
-                },
-    },
-    'without data->south_lat': {
-                'msgType': 'newBounds',
-                'data': {
-                    'east_lng': 37.65563964843751,
-                    'north_lat': 55.77367652953477,
-                    'west_lng': 37.54440307617188,
-                },
-    },
-    'without data->west_lng': {
-                'msgType': 'newBounds',
-                'data': {
-                    'east_lng': 37.65563964843751,
-                    'north_lat': 55.77367652953477,
-                    'south_lat': 55.72628839374007,
-                },
-    }
+    'without msgType': {'data': _VALID_BOUNDS},
+    'without data': {'msgType': 'newBounds'},
+    'without data->east_lng': {'msgType': 'newBounds', 'data': _bounds_without('east_lng')},
+    'without data->north_lat': {'msgType': 'newBounds', 'data': _bounds_without('north_lat')},
+    'without data->south_lat': {'msgType': 'newBounds', 'data': _bounds_without('south_lat')},
+    'without data->west_lng': {'msgType': 'newBounds', 'data': _bounds_without('west_lng')},
 }
 
+_BAD_FRAMES = tuple((desc, orjson.dumps(message)) for desc, message in _BAD_MESSAGES.items())
+
 
 async def main():
     try:
         async with open_websocket_url('ws://127.0.0.1:8000/ws') as ws:
             logging.info(f'Sending different bad messages to server')
-            for desc, message in _BAD_MESSAGES.items():
+            for desc, frame in _BAD_FRAMES:
                 logging.info(f'Sending message "{desc}"')
-                await ws.send_message(json.dumps(message, ensure_ascii=False))
+                await ws.send_message(frame)
                 # note - server sends not only errors but buses positions too.
                 # so if we just use ws.get_message() we will get just  'msgType': 'Buses' message
                 with trio.move_on_after(2) as cancel_scope:
@@ -1,13 +1,13 @@
-import contextvars
-import json
 import logging
+import re
 from datetime import datetime
 from functools import partial
-from typing import Optional, Tuple
+from typing import List, Literal, Optional, Tuple, Union
 
 import click
+import msgspec
+import numpy as np
 import trio
-from pydantic import BaseModel, ValidationError, validator
 from trio_websocket import (
     ConnectionClosed,
     WebSocketConnection,
@@ -19,11 +19,18 @@ logging.basicConfig(format='%(asctime)s :: %(levelname)s :: %(message)s')
 logger = logging.getLogger('bus_server')
 serve_websocket_http = partial(serve_websocket, ssl_context=None)
 
-_buses_data = {}
-window_boundaries = contextvars.ContextVar('window_boundaries')
+# Serialized buses. A bus is serialized when it comes, not every time it's sent to browsers.
+_buses_json = {}
+# Frames with visible buses keyed by window bounds, so browsers looking at the same view share one frame.
+# Emptied every time buses move, and when there are more frames than browsers, so panning doesn't pile them up.
+_browsers_frames = {}
+# Every connected browser has a channel to be woken up when there is something new to show.
+_browsers_notifiers = set()
+# Browser gets updates not more often than that (in seconds).
+BROWSER_UPDATE_INTERVAL = 0.1
 
 
-class Bus(BaseModel):
+class Bus(msgspec.Struct):
     """Information about bus."""
 
     busId: str
@@ -32,7 +39,7 @@ class Bus(BaseModel):
     route: str
 
 
-class WindowBound(BaseModel):
+class WindowBound(msgspec.Struct):
     """Map bounds. User can't see beyond the border."""
 
     north_lat: float
@@ -40,16 +47,6 @@ class WindowBound(BaseModel):
     west_lng: float
     east_lng: float
 
-    def is_inside(self, lat: float, lng: float) -> bool:
-        """Check if the point on a map is inside current bounds."""
-        inside_lat = self.south_lat < lat < self.north_lat
-        inside_lng = self.west_lng < lng < self.east_lng
-        return inside_lat and inside_lng
-
-    def is_bus_inside(self, bus: Bus) -> bool:
-        """Check if a bus is visible to the user with current bounds."""
-        return self.is_inside(lat=bus.lat, lng=bus.lng)
-
     def update(self, north_lat: float, south_lat: float, west_lng: float, east_lng: float) -> None:
         """Update bounds inplace."""
         self.north_lat = north_lat
@@ -58,17 +55,55 @@ class WindowBound(BaseModel):
         self.east_lng = east_lng
 
 
-class BrowserWindowMessage(BaseModel):
-    """Class for validation incoming data from user."""
+class BrowserWindowMessage(msgspec.Struct):
+    """Incoming message from user with new window boundaries."""
 
-    msgType: str
+    msgType: Literal['newBounds']
     data: WindowBound
 
-    @validator('msgType', pre=True)
-    def check_msg_type(cls, value: str) -> str:
-        if value != 'newBounds':
-            raise ValueError('Wrong message type')
-        return value
+
+class BusesPositions:
+    """
+    Coordinates of all buses.
+
+    Coordinates are kept in parallel NumPy arrays (a row per bus), so search
+    of visible buses is a vectorized comparison instead of a python loop.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.rows = {}
+        self.bus_ids = np.empty(capacity, dtype=object)
+        self.lat = np.empty(capacity, dtype=np.float64)
+        self.lng = np.empty(capacity, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def update(self, bus_id: str, lat: float, lng: float) -> None:
+        """Set new coordinates of a bus. New bus gets the next free row."""
+        row = self.rows.get(bus_id)
+        if row is None:
+            row = self.rows[bus_id] = len(self.rows)
+            if row == len(self.lat):
+                self._grow()
+            self.bus_ids[row] = bus_id
+        self.lat[row] = lat
+        self.lng[row] = lng
+
+    def find_inside(self, bounds: WindowBound) -> List[str]:
+        """Return ids of buses inside given bounds."""
+        lat, lng = self.lat[:len(self)], self.lng[:len(self)]
+        inside = (bounds.south_lat < lat) & (lat < bounds.north_lat) & (bounds.west_lng < lng) & (lng < bounds.east_lng)
+        return self.bus_ids[np.flatnonzero(inside)].tolist()
+
+    def _grow(self) -> None:
+        capacity = 2 * len(self.lat)
+        self.bus_ids = np.resize(self.bus_ids, capacity)
+        self.lat = np.resize(self.lat, capacity)
+        self.lng = np.resize(self.lng, capacity)
+
+
+_buses_positions = BusesPositions()
 
 
 @click.command()
@@ -102,34 +137,101 @@ async def run_server(browser_port: int, bus_port: int, host: str) -> None:
         logger.warning(f'Server has booted up at {datetime.utcnow()}')
 
 
-def format_errors(error: ValidationError) -> dict:
-    """Structure pydantic validation errors into a dict."""
-    return {
-        'msgType': 'Errors',
-        'errors': [{
-            'loc': err['loc'],
-            'msg': err['msg'],
-            'type': err['type'],
-        } for err in error.errors()]
-    }
+# Errors frame without the errors list. Only the list changes from one bad message to another.
+_ERRORS_FRAME = b'{"msgType":"Errors","errors":%s}'
 
 
-def validate_bus(message: str) -> Tuple[Bus, Optional[dict]]:
-    bus, errors = None, None
-    try:
-        bus = Bus.parse_raw(message)
-    except ValidationError as e:
-        errors = format_errors(e)
-    return bus, errors
+def format_errors(errors: List[dict]) -> bytes:
+    """Make a serialized message with validation errors (in pydantic format)."""
+    return _ERRORS_FRAME % msgspec.json.encode(errors)
+
+
+# Decoders validate messages while parsing them, so invalid data never becomes python objects.
+_buses_decoder = msgspec.json.Decoder(Union[List[Bus], Bus])
+# Used when a list of buses is invalid, to find and keep valid buses in it.
+_raw_buses_decoder = msgspec.json.Decoder(List[msgspec.Raw])
+_bus_decoder = msgspec.json.Decoder(Bus)
+_window_message_decoder = msgspec.json.Decoder(BrowserWindowMessage)
+_error_path_parts = re.compile(r'\.(\w+)|\[(\d+)\]')
+# Pydantic error types for msgspec messages starting with these words. Other validation errors are value errors.
+_ERROR_TYPES = {
+    'Object missing required field': 'value_error.missing',
+    'Expected `float`': 'type_error.float',
+    'Expected `str`': 'type_error.str',
+    'Expected `object`': 'type_error.dict',
+}
 
-def validate_window_bounds(message: str) -> Tuple[WindowBound, Optional[dict]]:
+
+def describe_decode_error(error: msgspec.DecodeError, loc: tuple = ()) -> dict:
+    """
+    Describe msgspec error in the same structure as pydantic errors.
+
+    msgspec error looks like "Expected `float`, got `str` - at `$[0].lat`".
+    """
+    msg, _, path = str(error).partition(' - at `$')
+    loc += tuple(int(index) if index else name for name, index in _error_path_parts.findall(path))
+    if msg.startswith('Object missing required field'):
+        loc += (msg.split('`')[1],)
+    if isinstance(error, msgspec.ValidationError):
+        error_type = next((type_ for prefix, type_ in _ERROR_TYPES.items() if msg.startswith(prefix)), 'value_error')
+    else:
+        error_type = 'value_error.jsondecode'
+    return {'loc': loc or ('__root__',), 'msg': msg, 'type': error_type}
+
+
+def validate_buses(message: Union[str, bytes]) -> Tuple[List[Bus], Optional[List[dict]]]:
+    """
+    Validate incoming message with one bus or a list of buses.
+
+    Invalid buses in a list are reported, the rest of the list is still returned.
+    """
+    try:
+        buses = _buses_decoder.decode(message)
+    except msgspec.ValidationError as e:
+        try:
+            raw_buses = _raw_buses_decoder.decode(message)
+        except msgspec.ValidationError:
+            # It's not a list, just a bad bus.
+            return [], [describe_decode_error(e)]
+        except msgspec.DecodeError as json_error:
+            return [], [describe_decode_error(json_error)]
+        buses, errors = [], []
+        for index, raw_bus in enumerate(raw_buses):
+            try:
+                buses.append(_bus_decoder.decode(raw_bus))
+            except msgspec.ValidationError as bus_error:
+                errors.append(describe_decode_error(bus_error, loc=(index,)))
+        return buses, errors
+    except msgspec.DecodeError as e:
+        return [], [describe_decode_error(e)]
+    return buses if isinstance(buses, list) else [buses], None
+
+
+def validate_window_bounds(message: Union[str, bytes]) -> Tuple[Optional[WindowBound], Optional[List[dict]]]:
     """Validate incoming message with user's window boundaries."""
-    new_window, errors = None, None
     try:
-        new_window = BrowserWindowMessage.parse_raw(message).data
-    except ValidationError as e:
-        errors = format_errors(e)
-    return new_window, errors
+        return _window_message_decoder.decode(message).data, None
+    except msgspec.DecodeError as e:
+        return None, [describe_decode_error(e)]
+
+
+def store_bus(bus: Bus) -> None:
+    """Save bus into in-memory storage."""
+    _buses_positions.update(bus.busId, bus.lat, bus.lng)
+    _buses_json[bus.busId] = msgspec.json.encode(bus)
+
+
+def notify(notifier: trio.MemorySendChannel) -> None:
+    """
+    Wake up a browser's sender.
+
+    Notifier channel holds only one notification, so a burst of changes
+    is merged into one update for the browser.
+    """
+    try:
+        notifier.send_nowait(None)
+    except trio.WouldBlock:
+        pass
 
 
 async def handle_bus(request: WebSocketRequest) -> None:
@@ -137,18 +239,25 @@ async def handle_bus(request: WebSocketRequest) -> None:
     Receives messages with buses location updates and update in-memory buses storage.
 
     message example - '{"busId": "bus-0001", "lat": 55.03332, "lng": 35.4564, "route": "14k"}'
+    Few updates can be sent at once as a list - '[{"busId": "bus-0001", ...}, {"busId": "bus-0002", ...}]'
     """
     ws = await request.accept()
     logger.debug('grab_bus: Connection established')
     while True:
         try:
             message = await ws.get_message()
-            bus, errors = validate_bus(message)
+            buses, errors = validate_buses(message)
             if errors:
-                logger.error(f'grab_bus: Bad bus message - {message}')
-                await ws.send_message(json.dumps(errors))
+                # Bus emulators don't read answers, so errors are only logged.
+                logger.error(f'grab_bus: Bad bus message - {message}, errors - {errors}')
+            if not buses:
+                # Nothing has moved, browsers' frames are still up to date.
                 continue
-            _buses_data[bus.busId] = bus
+            for bus in buses:
+                store_bus(bus)
+            _browsers_frames.clear()
+            for notifier in _browsers_notifiers:
+                notify(notifier)
         except ConnectionClosed:
             logger.debug('grab_bus: Connection closed')
             break
@@ -164,14 +273,21 @@ async def handle_browser(request: WebSocketRequest) -> None:
     ws = await request.accept()
     user_uri = request.remote.url
     logger.debug(f'handle_browser: Incoming user connection from {user_uri}')
-    window_boundaries.set(WindowBound(north_lat=0, south_lat=0, west_lng=0, east_lng=0))
-    async with trio.open_nursery() as nursery:
-        nursery.start_soon(listen_to_browser, ws)
-        nursery.start_soon(tell_to_browser, ws)
+    bounds = WindowBound(north_lat=0, south_lat=0, west_lng=0, east_lng=0)
+    notifier, notifications = trio.open_memory_channel(1)
+    _browsers_notifiers.add(notifier)
+    try:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(tell_to_browser, ws, bounds, notifications)
+            await listen_to_browser(ws, bounds, notifier)
+            # Nobody to tell about buses anymore.
+            nursery.cancel_scope.cancel()
+    finally:
+        _browsers_notifiers.discard(notifier)
     logger.debug(f'handle_browser: User {user_uri} has disconnected.')
 
 
-async def listen_to_browser(ws: WebSocketConnection) -> None:
+async def listen_to_browser(ws: WebSocketConnection, bounds: WindowBound, notifier: trio.MemorySendChannel) -> None:
     """
     Listen for an incoming websocket messages with new window boundaries.
 
@@ -192,38 +308,58 @@ async def listen_to_browser(ws: WebSocketConnection) -> None:
             new_window, errors = validate_window_bounds(message)
             if errors:
                 logger.error(f'listen_browser: Bad newBounds message - {message}')
-                await ws.send_message(json.dumps(errors))
+                await ws.send_message(format_errors(errors).decode())
                 continue
-            current_bounds = window_boundaries.get()
-            current_bounds.update(
+            bounds.update(
                 south_lat=new_window.south_lat,
                 north_lat=new_window.north_lat,
                 west_lng=new_window.west_lng,
                 east_lng=new_window.east_lng,
             )
+            notify(notifier)
             logger.debug('listen_browser: Window boundaries updated')
         except ConnectionClosed:
             logger.debug('listen_to_browser: Connection closed')
             break
 
 
-async def tell_to_browser(ws: WebSocketConnection) -> None:
-    """Send visible buses to a user."""
-    while True:
-        bounds = window_boundaries.get()
-        buses_inside = [
-            bus.dict() for bus in _buses_data.values() if bounds.is_bus_inside(bus)
-        ]
-        response_msg = {
-            'msgType': 'Buses',
-            'buses': buses_inside,
-        }
+def build_buses_frame(bounds: WindowBound) -> str:
+    """Make a message with buses visible inside bounds. Browser expects text frames, so it's a string."""
+    buses_inside = b','.join([_buses_json[bus_id] for bus_id in _buses_positions.find_inside(bounds)])
+    return (b'{"msgType":"Buses","buses":[%s]}' % buses_inside).decode()
+
+
+async def tell_to_browser(ws: WebSocketConnection, bounds: WindowBound, notifications: trio.MemoryReceiveChannel) -> None:
+    """
+    Send visible buses to a user every time buses or user's window boundaries change.
+
+    Updates are throttled - there are at least BROWSER_UPDATE_INTERVAL seconds between them.
+    """
+    last_response_msg = None
+    next_update_time = trio.current_time()
+    async for _ in notifications:
+        await trio.sleep_until(next_update_time)
+        # Changes which came during the pause are shown by this update too.
+        try:
+            notifications.receive_nowait()
+        except trio.WouldBlock:
+            pass
+        bounds_key = (bounds.north_lat, bounds.south_lat, bounds.west_lng, bounds.east_lng)
+        response_msg = _browsers_frames.get(bounds_key)
+        if response_msg is None:
+            if len(_browsers_frames) >= len(_browsers_notifiers):
+                _browsers_frames.clear()
+            response_msg = _browsers_frames[bounds_key] = build_buses_frame(bounds)
+        if response_msg == last_response_msg:
+            # Only buses out of user's sight have moved.
+            continue
         try:
-            await ws.send_message(json.dumps(response_msg, ensure_ascii=False))
+            await ws.send_message(response_msg)
         except ConnectionClosed:
             logger.debug('tell_to_browser: connection closed')
             break
-        await trio.sleep(0.1)
+        last_response_msg = response_msg
+        next_update_time = trio.current_time() + BROWSER_UPDATE_INTERVAL
 
 
 if __name__ == '__main__':